@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Optional dependencies used to speed things up, with fallbacks if they aren't installed
+
+
+"""
+
+import numpy as np
+
+try:
+    import bottleneck as bn
+    nanmedian = bn.nanmedian
+except ImportError:
+    nanmedian = np.nanmedian
+
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        """Stand-in for ``numba.njit`` which leaves the function as plain python"""
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
@@ -11,12 +11,21 @@ Usage:
         fname = 'KMOS_SCI_RECONSTRUCTED.fits'
         exp = exposure.Exposure(fname)
 
+    The FITS file is memory mapped, so close it when finished, or use
+    the exposure as a context manager::
+
+        with exposure.Exposure(fname) as exp:
+            print(exp.mode)
+
 """
 
 __author__ = ["Charlotte Mason (UCLA)", "Antonello Calabro' (OAR)"]
 
+import re
 import astropy.io.fits as fits
 
+from ._compat import fitsio
+
 
 class Exposure(object):
     """A single KMOS exposure object
@@ -27,8 +36,10 @@ class Exposure(object):
         filename (str): filepath to SCI_RECONSTRUCTED fits file
         hdulist (astropy sequence of HDU objects or single HDU): HDUlist of IFUs in the exposure
         hdr (astropy header): FITS header
+        ifu_ext (dict): index in ``hdulist`` of the data extension of each IFU
         filter (str): KMOS filter used
         frame_time (str): date of observations
+        arm_name (dict): target name for each IFU
 
 
     """
@@ -43,11 +54,69 @@ class Exposure(object):
         """
 
         self.filename = reconstructed_fits_path
-        self.hdulist  = fits.open(self.filename)
-        self.hdr      = self.hdulist[0].header
-        self.filter   = self.hdr['HIERARCH ESO INS FILT1 ID']
+        self._hdulist = fits.open(self.filename, memmap=True, lazy_load_hdus=True)
+
+        # Find the extension index of each IFU, and whether it has data, in one pass over the headers
+        ifu_ext, ifu_has_data = {}, {}
+        for ext_index, ext in enumerate(self._hdulist):
+            match = re.match(r'IFU\.(\d+)\.DATA$', ext.header.get('EXTNAME', ''))
+            if match:
+                ifu = int(match.group(1))
+                ifu_ext[ifu] = ext_index
+                ifu_has_data[ifu] = ext.header.get('NAXIS', 0) > 0 and ext.header.get('NAXIS3', 0) > 0
+
+        self._inspect(self._hdulist[0].header, ifu_ext, ifu_has_data, vb)
+
+        return
+
+    @classmethod
+    def from_fitsio(cls, reconstructed_fits_path, vb=False):
+        """Make an Exposure reading only the headers, with ``fitsio`` if it is installed
 
-        self.frame_time = self.hdr['DATE-OBS']
+        Quicker than the astropy header parsing when inspecting many frames.
+        The astropy ``hdulist`` and ``hdr`` are only opened if they are used.
+
+        Args:
+            reconstructed_fits_path (str): File path of SCI_RECONSTRUCTED individual frame.
+            vb (bool): verbose?
+
+        Returns:
+            exposure (object): exposure object
+
+
+        """
+        if fitsio is None:
+            return cls(reconstructed_fits_path, vb=vb)
+
+        exposure = cls.__new__(cls)
+        exposure.filename = reconstructed_fits_path
+        exposure._hdulist = None
+
+        ifu_ext, ifu_has_data = {}, {}
+        with fitsio.FITS(exposure.filename) as fitsfile:
+            prihdr = fitsfile[0].read_header()
+            for ext_index, ext in enumerate(fitsfile):
+                match = re.match(r'IFU\.(\d+)\.DATA$', ext.get_extname())
+                if match:
+                    ifu = int(match.group(1))
+                    ifu_ext[ifu] = ext_index
+                    dims = ext.get_info()['dims']
+                    ifu_has_data[ifu] = len(dims) == 3 and dims[0] > 0
+
+        exposure._inspect(prihdr, ifu_ext, ifu_has_data, vb)
+
+        return exposure
+
+    def _inspect(self, prihdr, ifu_ext, ifu_has_data, vb):
+        """Set up the exposure attributes from the primary header and the IFU extensions"""
+
+        self.filter     = prihdr['HIERARCH ESO INS FILT1 ID']
+        self.frame_time = prihdr['DATE-OBS']
+
+        # Target name on each arm (IFU)
+        self.arm_name = {ifu: prihdr.get('HIERARCH ESO OCS ARM%i NAME' % ifu, '') for ifu in range(1, 25)}
+
+        self.ifu_ext = ifu_ext
 
         self.vb = vb
 
@@ -57,13 +126,11 @@ class Exposure(object):
         # Work out whether we are in science (A) or sky (B) mode
         count = 0
         for ifu in range(1, 25):
-            try:
-                ext = self.hdulist['IFU.%i.DATA' % ifu]
-                if ext.data is not None:
+            if ifu in self.ifu_ext:
+                if ifu_has_data[ifu]:
                     count = count + 1
-            except:
-                if self.vb:
-                    print('WARNING: no IFU %i' % ifu)
+            elif self.vb:
+                print('WARNING: no IFU %i' % ifu)
 
         if count > 5:
             self.mode = 'A'
@@ -76,3 +143,28 @@ class Exposure(object):
         self.starfile = None
 
         return
+
+    @property
+    def hdulist(self):
+        """astropy HDUList of the exposure, opened when first used"""
+        if self._hdulist is None:
+            self._hdulist = fits.open(self.filename, memmap=True, lazy_load_hdus=True)
+        return self._hdulist
+
+    @property
+    def hdr(self):
+        """astropy primary header of the exposure"""
+        return self.hdulist[0].header
+
+    def close(self):
+        """Close the FITS file of the exposure"""
+        if self._hdulist is not None:
+            self._hdulist.close()
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -6,24 +6,66 @@
 
 __author__ = ["Charlotte Mason (UCLA)"]
 
+import io
+import os
+import re
 import glob
+import fnmatch
+import functools
+
+
+__all__ = ["insensitive_glob", "find_exposures", "write_fits"]
+
+# Products of post-processing which are not individual science exposures
+_EXCLUDE_TAGS = ('star', 'SKYFIX', 'SKYSPEC', 'MASK', 'COMBINE', 'COLL', 'BADCALIB', 'FLUXFIX')
+
+
+@functools.lru_cache(maxsize=128)
+def _insensitive_regex(pattern):
+    """Compiled case insensitive regex for a shell-style file name pattern"""
+    return re.compile(fnmatch.translate(pattern), re.IGNORECASE)
 
 
 def insensitive_glob(pattern):
     """Case insensitive find file names
 
+    Lists the directory once and matches the file names against the pattern,
+    ignoring case. The directory part is only searched for if it contains
+    wildcards or does not exist as written.
+
     Args:
         pattern (str): pattern to search for
 
     Returns:
         file_list (list): sorted list of filenames which match pattern
     """
-    def either(c):
-        return '[%s%s]' % (c.lower(), c.upper()) if c.isalpha() else c
+    dirname, basename = os.path.split(pattern)
+
+    if glob.has_magic(dirname) or (dirname and not os.path.isdir(dirname)):
+        dirnames = insensitive_glob(dirname)
+    else:
+        dirnames = [dirname]
+
+    # A trailing separator only matches directories, as with glob
+    if not basename:
+        return sorted(os.path.join(dirname, '') for dirname in dirnames if dirname and os.path.isdir(dirname))
+
+    regex = _insensitive_regex(basename)
+
+    file_list = []
+    for dirname in dirnames:
+        try:
+            names = os.listdir(dirname or os.curdir)
+        except OSError:
+            continue
+
+        # Like glob, only match hidden files if asked for explicitly
+        if not basename.startswith('.'):
+            names = [name for name in names if not name.startswith('.')]
 
-    file_list = sorted(glob.glob(''.join(map(either, pattern))))
+        file_list += [os.path.join(dirname, name) for name in names if regex.match(name)]
 
-    return file_list
+    return sorted(file_list)
 
 
 def find_exposures(dir='*', prefix='*'):
@@ -36,16 +78,35 @@ def find_exposures(dir='*', prefix='*'):
     """
     dir_prefix = '%s/%s' % (dir, prefix)
 
-    sci_exposures = set(glob.glob('%s*SCI_RECONSTRUCTED*.fits' % dir_prefix)) \
-                - set(glob.glob('%s*star*.fits' % dir_prefix)) \
-                - set(glob.glob('%s*SKYFIX*.fits' % dir_prefix)) \
-                - set(glob.glob('%s*SKYSPEC*.fits' % dir_prefix)) \
-                - set(glob.glob('%s*MASK*.fits' % dir_prefix)) \
-                - set(glob.glob('%s*COMBINE*.fits' % dir_prefix)) \
-                - set(glob.glob('%s*COLL*.fits' % dir_prefix))  \
-                - set(glob.glob('%s*BADCALIB*.fits' % dir_prefix))  \
-                - set(glob.glob('%s*FLUXFIX*.fits' % dir_prefix))
+    sci_exposures = set(fname for fname in glob.glob('%s*SCI_RECONSTRUCTED*.fits' % dir_prefix)
+                        if not any(tag in os.path.basename(fname) for tag in _EXCLUDE_TAGS))
 
     print(len(sci_exposures), 'science exposures found')
 
     return sci_exposures
+
+
+def write_fits(hdulist, filename, overwrite=True):
+    """Write an HDUList to a FITS file in a single write
+
+    The file is built in memory first, so the many small header writes
+    astropy makes end up as one write to disk (much faster on network
+    file systems). Headers are not verified and no checksums are computed,
+    as the HDUs come from files the pipeline already wrote.
+
+    Args:
+        hdulist (astropy HDUList): HDUs to save
+        filename (str): filepath to save to
+        overwrite (bool): overwrite ``filename`` if it already exists
+
+    """
+    if os.path.exists(filename) and not overwrite:
+        raise OSError('File %s already exists' % filename)
+
+    buffer = io.BytesIO()
+    hdulist.writeto(buffer, output_verify='ignore', checksum=False)
+
+    with open(filename, 'wb') as f:
+        f.write(buffer.getbuffer())
+
+    return
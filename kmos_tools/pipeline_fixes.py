@@ -9,10 +9,13 @@
 
 """
 import os
+import shutil
 import subprocess
 import astropy.io.fits as fits
 import datetime
 
+from .io import insensitive_glob, write_fits
+
 
 __all__ = ["rotation_fix", "flux_fix"]
 
@@ -47,22 +50,18 @@ def rotation_fix(exposure, updateheader=False, keepsize=False):
         rotangle = exposure.hdr['HIERARCH ESO OCS ROT OFFANGLE']
 
         # Rotate
+        kmo_rotate = ['esorex', 'kmo_rotate', '--rotations=%f' % rotangle]
         if keepsize:
-            extrapolate = '--extrapolate'
-        else:
-            extrapolate = ''
-
-        kmo_rotate = 'esorex kmo_rotate --rotations="%f" %s %s' % (rotangle, extrapolate, exposure.filename)
-        os.system(kmo_rotate)
+            kmo_rotate.append('--extrapolate')
+        kmo_rotate.append(exposure.filename)
+        subprocess.run(kmo_rotate, check=True)
 
-        status, rotfile = subprocess.getstatusoutput("find . -maxdepth 1 -iname ROTATE.fits")
+        rotfile = insensitive_glob('ROTATE.fits')[0]
 
         # Rename files
         old_filename   = exposure.filename.replace('.fits', '_rotoffangle%.0f.fits' % (rotangle))
-        rename_oldfile = 'mv %s %s' % (exposure.filename, old_filename)
-        rename_newfile = 'mv %s %s' % (rotfile, exposure.filename)
-        os.system(rename_oldfile)
-        os.system(rename_newfile)
+        os.replace(exposure.filename, old_filename)
+        shutil.move(rotfile, exposure.filename)
 
         if updateheader:
 
@@ -86,7 +85,8 @@ def rotation_fix(exposure, updateheader=False, keepsize=False):
                     newhdu[ext].header['CD1_2'] = 0.
                     newhdu[ext].header['CD2_2'] = newhdu[ext].header['CDELT2']
 
-            newhdu.writeto(exposure.filename, clobber=True)
+            write_fits(newhdu, exposure.filename)
+            newhdu.close()
 
         print(exposure.filename, 'rotation fixed')
 
@@ -115,7 +115,7 @@ def flux_fix(exposure, clobber=True):
     else:
         count = 0
         for ifu in range(1, 25):
-            ext = exposure.hdulist['IFU.'+str(ifu)+'.DATA']
+            ext = exposure.hdulist[exposure.ifu_ext[ifu]]
             if ext.data is not None:
                 # Count IFUs with data
                 count = count + 1
@@ -128,7 +128,7 @@ def flux_fix(exposure, clobber=True):
 
         print(count, 'IFUs with science data')
 
-        exposure.hdulist.writeto(exposure.filename_fluxfix, clobber=clobber)
+        write_fits(exposure.hdulist, exposure.filename_fluxfix, overwrite=clobber)
         print('Saved fixed flux to', exposure.filename_fluxfix)
 
     return
@@ -10,13 +10,14 @@ Works on individual exposures which must then be combined via ``kmos_combine``.
 import os
 import numpy as np
 import astropy.io.fits as fits
-import itertools as it
 import datetime
 import matplotlib.pyplot as plt
-from lmfit import Parameters, minimize
 
+from .io import write_fits
+from ._compat import nanmedian, njit, prange, HAS_NUMBA
 
-__all__ = ["make_sky_residual_spectra", "subtract_sky_residual_spectra", "sky_residual"]
+
+__all__ = ["make_sky_residual_spectra", "subtract_sky_residual_spectra", "fit_sky_scale", "sky_residual"]
 
 
 def make_sky_residual_spectra(exposure, use_named_targets=[''],
@@ -52,15 +53,14 @@ def make_sky_residual_spectra(exposure, use_named_targets=[''],
         detector1, detector2, detector3 = [], [], []
         for ifu in range(1, 25):
 
-            ext = exposure.hdulist['IFU.' + str(ifu) + '.DATA']
+            ext = exposure.hdulist[exposure.ifu_ext[ifu]]
 
             if len(ext.shape) > 0:
 
-                ifu_comment = 'HIERARCH ESO OCS ARM' + str(ifu) + ' NAME'
                 ifu_header  = ext.header
 
                 # Use only frames with named targets for sky subtraction
-                if any([name in exposure.hdr[ifu_comment] for name in use_named_targets]):
+                if any([name in exposure.arm_name[ifu] for name in use_named_targets]):
                     ifu_cube = ext.data
 
                     if 1 <= ifu <= 8:
@@ -73,42 +73,29 @@ def make_sky_residual_spectra(exposure, use_named_targets=[''],
         len_for_stack = len(detector1) + len(detector2) + len(detector3)
         assert len_for_stack > 0, "Error, no IFUs used to create sky residual spectrum"
 
-        # Stack all spectra
-        detector1, detector2, detector3 = np.array(detector1), np.array(detector2), np.array(detector3)
-        if detector1.size > 0 and detector2.size > 0 and detector3.size > 0:
-            detector_all    = np.concatenate((detector1, detector2, detector3), axis=0)
-        elif detector1.size > 0 and detector2.size > 0:
-            detector_all = np.concatenate((detector1, detector2), axis=0)
-        elif detector1.size > 0 and detector3.size > 0:
-            detector_all    = np.concatenate((detector1, detector3), axis=0)
-        elif detector2.size > 0 and detector3.size > 0:
-            detector_all    = np.concatenate((detector2, detector3), axis=0)
-        else:
-            if detector1.size > 0:
-                detector_all = detector1
-            elif detector2.size > 0:
-                detector_all = detector2
-            elif detector3.size > 0:
-                detector_all = detector3
+        # Stack all spectra as [wavelength, IFUs x spatial pixels], detector by detector,
+        # so the stack for each detector is a slice of the stack of all of them
+        detectors = [detector1, detector2, detector3]
+        stack_all = np.concatenate([cube.reshape(cube.shape[0], -1) for cube in detector1 + detector2 + detector3], axis=1)
+        stack_edges = np.cumsum([0] + [sum(cube[0].size for cube in detector) for detector in detectors])
 
         # Generate median of 'empty' stacks to use as sky residual spectra for each detector
-        skyspec_1D_all = np.nanmedian(detector_all, axis=(0, 2, 3))
+        skyspec_1D_all = nanmedian(stack_all, axis=1)
         skyspec_1D = {}
-        detectors = [detector1, detector2, detector3]
         for i in range(len(detectors)):
-            if detectors[i].shape[0] > 1:
-                skyspec_1D[i] = np.nanmedian(detectors[i], axis=(0, 2, 3))
+            if len(detectors[i]) > 1:
+                skyspec_1D[i] = nanmedian(stack_all[:, stack_edges[i]:stack_edges[i+1]], axis=1)
             else:
                 skyspec_1D[i] = None
 
         if plot:
             plt.figure(figsize=(10, 5))
 
-            plt.plot(skyspec_1D_all, lw=1, alpha=0.8, label='All detectors (%i IFUs)' % detector_all.shape[0], zorder=10)
+            plt.plot(skyspec_1D_all, lw=1, alpha=0.8, label='All detectors (%i IFUs)' % len_for_stack, zorder=10)
 
             for i in range(len(skyspec_1D)):
                 if skyspec_1D[i] is not None:
-                    plt.plot(skyspec_1D[i], lw=1, alpha=0.8, label='Detector %i (%i IFUs)' % (i, detectors[i].shape[0]))
+                    plt.plot(skyspec_1D[i], lw=1, alpha=0.8, label='Detector %i (%i IFUs)' % (i, len(detectors[i])))
 
             ymin, ymax = np.nanpercentile(skyspec_1D_all, 1), np.nanpercentile(skyspec_1D_all, 99)
             if ymin > 0.: ymin = -1.e-18
@@ -154,7 +141,7 @@ def make_sky_residual_spectra(exposure, use_named_targets=[''],
 
         # Create hdu list and write
         hdulist = fits.HDUList([hdu, hdu_all, hdu_1, hdu_2, hdu_3])
-        hdulist.writeto(exposure.filename_skyspec, clobber=True)
+        write_fits(hdulist, exposure.filename_skyspec)
         print('Saved fits file to ', exposure.filename_skyspec)
 
     return
@@ -172,6 +159,9 @@ def subtract_sky_residual_spectra(exposure, clobber=True, plot=True):
 
     .. math:: \left( \frac{f_{x, y, \lambda}^\mathrm{skysub}}{\sigma_\lambda} \right)^2
 
+    The model is linear in :math:`A_{x, y}`, so it is solved in closed form for all
+    spatial pixels at once (see :func:`fit_sky_scale`).
+
     Args:
         exposure (object): exposure object
         clobber (bool): Make a new sky spectrum if it already exists
@@ -190,66 +180,159 @@ def subtract_sky_residual_spectra(exposure, clobber=True, plot=True):
 
     else:
 
-        skyspec_all = fits.open(exposure.filename_skyspec)
+        # Read the sky spectrum of each detector, using the median of all detectors if there isn't one
+        sky_by_detector = {}
+        with fits.open(exposure.filename_skyspec) as skyspec_all:
+            for detector in (1, 2, 3):
+                if skyspec_all[detector+1].data is not None:
+                    sky_by_detector[detector] = np.array(skyspec_all[detector+1].data)
+                else:
+                    print('No sky spectrum for detector %i, so using the median' % detector)
+                    sky_by_detector[detector] = np.array(skyspec_all[1].data)
 
+        # Group IFUs with data by detector
+        detector_ifus = {1: [], 2: [], 3: []}
         for ifu in range(1, 25):
+            ext = exposure.hdulist[exposure.ifu_ext[ifu]]
+            if len(ext.shape) > 0:
+                detector_ifus[(ifu - 1) // 8 + 1].append(ifu)
 
-            ext = exposure.hdulist['IFU.' + str(ifu) + '.DATA']
+        for detector, ifus in detector_ifus.items():
 
-            if len(ext.shape) > 0:
+            if len(ifus) == 0:
+                continue
 
-                # Finding detector
-                if 1 <= ifu <= 8:
-                    detector = 1
-                elif 9 <= ifu <= 16:
-                    detector = 2
-                elif 17 <= ifu <= 24:
-                    detector = 3
+            skyspec = sky_by_detector[detector]
 
-                skyspec  = skyspec_all[detector+1].data
+            # Stack all IFUs on the detector [ifu, wavelength, y, x], as floats in native byte order.
+            # This is the only copy of the data, the sky is subtracted from it in place
+            exts  = [exposure.hdulist[exposure.ifu_ext[ifu]] for ifu in ifus]
+            dat4D = np.empty((len(exts),) + exts[0].shape, dtype=np.result_type(exts[0].data.dtype, np.float32))
+            for dat3D, ext in zip(dat4D, exts):
+                dat3D[...] = ext.data
 
-                # Do sky subtraction
-                if skyspec is None:
-                    print('No sky spectrum for detector %i, so using the median' % detector)
-                    skyspec = skyspec_all[1].data
-
-                # Estimate 1D error from std of flux
-                dat3D = ext.data.copy()
-                err1D = np.nanstd(dat3D, axis=(1, 2))/np.sqrt(dat3D.shape[1] * dat3D.shape[2])
-
-                # Get rescaling # TODO better minimise
-                skyscale2D   = np.zeros_like(dat3D[0])
-                chisquared2D = np.zeros_like(dat3D[0])
-                for i, j in it.product(np.arange(dat3D.shape[1]), np.arange(dat3D.shape[2])):
-                    params = Parameters()
-                    params.add('scale', value=1.)
-                    out = minimize(sky_residual, params, args=(skyspec, dat3D[:, i, j], err1D))
-                    skyscale2D[i, j]   = out.params['scale'].value
-                    chisquared2D[i, j] = out.chisqr
-
-                # Sky subtract
-                data_corr = dat3D - skyscale2D*skyspec[:, None, None]
-
-                # Subtract median flux if not S2
-                ifu_comment = 'HIERARCH ESO OCS ARM' + str(ifu) + ' NAME'
-                if 'S2' not in exposure.hdr[ifu_comment]:
-                    data_corr -= np.nanmedian(data_corr)
-
-                ext.data  = data_corr
+            # Estimate 1D error from std of flux in all IFUs on the detector
+            err1D = np.nanstd(dat4D, axis=(0, 2, 3))/np.sqrt(dat4D.shape[2] * dat4D.shape[3])
+
+            # Get rescaling for every spatial pixel of every IFU
+            skyscale, chisquared = fit_sky_scale(dat4D, skyspec, err1D)
+
+            # Sky subtract
+            for dat3D_corr, skyscale2D in zip(dat4D, skyscale):
+                dat3D_corr -= skyscale2D.astype(dat3D_corr.dtype)*skyspec[:, None, None]
+
+            # Subtract median flux if not S2, with the medians of all IFUs in one pass.
+            # (The mean would be cheaper, but is pulled up by the flux of the targets)
+            not_S2 = np.array(['S2' not in exposure.arm_name[ifu] for ifu in ifus])
+            if not_S2.any():
+                median_flux = nanmedian(dat4D.reshape(dat4D.shape[0], -1), axis=1)
+                dat4D -= np.where(not_S2, median_flux, 0.).astype(dat4D.dtype)[:, None, None, None]
+
+            for ext, dat3D_corr in zip(exts, dat4D):
+                ext.data  = dat3D_corr
                 now       = datetime.datetime.now()
                 ext.header['SKY RESIDUALS CORRECTED'] = str(now)
 
-        exposure.hdulist.writeto(exposure.filename_skycorr, clobber=clobber)
+        write_fits(exposure.hdulist, exposure.filename_skycorr, overwrite=clobber)
         print('Saved Sky Fix to', exposure.filename_skycorr)
 
         return
 
 
+def fit_sky_scale(data, sky, err):
+    r"""Least-squares rescaling of a 1D sky spectrum in every spatial pixel of a cube
+
+    Minimising :math:`\chi^2 = \sum_\lambda (f_\lambda - A s_\lambda)^2 / \sigma_\lambda^2`
+    gives the closed-form solution
+
+    .. math:: A = \frac{\sum_\lambda f_\lambda s_\lambda / \sigma_\lambda^2}{\sum_\lambda s_\lambda^2 / \sigma_\lambda^2}
+
+    Wavelengths where the data, sky or error are not finite do not contribute,
+    as in :func:`sky_residual`. Stacks of cubes, e.g. all the IFUs on a detector
+    [ifu, wavelength, y, x], are solved at once.
+
+    Args:
+        data (ndarray): 3D data cube [wavelength, y, x], or stack of cubes
+        sky (ndarray): 1D sky spectrum
+        err (ndarray): 1D error spectrum
+
+    Returns:
+        scale (ndarray): 2D map (or stack of maps) of sky rescaling, A
+        chisquared (ndarray): 2D map (or stack of maps) of chi-squared of the fit
+
+
+    """
+    weight = 1. / np.asarray(err, dtype=float)**2.
+    good1D = np.isfinite(sky) & np.isfinite(weight)
+    weight = np.where(good1D, weight, 0.)
+    sky    = np.where(good1D, sky, 0.).astype(float)
+
+    if HAS_NUMBA:
+        # numba needs native byte order, FITS data is big-endian
+        data4D = np.asarray(data).reshape((-1,) + np.shape(data)[-3:])
+        data4D = data4D.astype(data4D.dtype.newbyteorder('='), copy=False)
+
+        scale      = np.empty((data4D.shape[0],) + data4D.shape[2:])
+        chisquared = np.empty_like(scale)
+        _fit_sky_scale_numba(data4D, sky, weight, scale, chisquared)
+
+        shape = np.shape(data)[:-3] + np.shape(data)[-2:]
+        return scale.reshape(shape), chisquared.reshape(shape)
+
+    good = np.isfinite(data)
+    dat  = np.where(good, data, 0.)
+
+    num = np.einsum('l,...lij->...ij', sky * weight, dat)
+    den = np.einsum('l,...lij->...ij', sky * sky * weight, good)
+    scale = np.divide(num, den, out=np.zeros_like(num), where=den > 0.)
+
+    model = scale[..., None, :, :] * sky[:, None, None]
+    chisquared = np.einsum('l,...lij->...ij', weight, np.where(good, data - model, 0.)**2.)
+
+    return scale, chisquared
+
+
+@njit(parallel=True, fastmath={'reassoc', 'contract', 'arcp'}, cache=True)
+def _fit_sky_scale_numba(data, sky, weight, scale, chisquared):
+    """Fused loops for :func:`fit_sky_scale` on a stack of cubes [cube, wavelength, y, x]
+
+    Keeps the NaN checks, so only the fastmath flags which assume finite values are left out.
+    """
+    n_cube, n_wave, ny, nx = data.shape
+
+    for k in prange(n_cube):
+        num = np.zeros((ny, nx))
+        den = np.zeros((ny, nx))
+        for wl in range(n_wave):
+            sw  = sky[wl] * weight[wl]
+            ssw = sky[wl] * sw
+            for i in range(ny):
+                for j in range(nx):
+                    if np.isfinite(data[k, wl, i, j]):
+                        num[i, j] += data[k, wl, i, j] * sw
+                        den[i, j] += ssw
+
+        for i in range(ny):
+            for j in range(nx):
+                scale[k, i, j] = num[i, j] / den[i, j] if den[i, j] > 0. else 0.
+                chisquared[k, i, j] = 0.
+
+        for wl in range(n_wave):
+            for i in range(ny):
+                for j in range(nx):
+                    if np.isfinite(data[k, wl, i, j]):
+                        resid = data[k, wl, i, j] - scale[k, i, j] * sky[wl]
+                        chisquared[k, i, j] += weight[wl] * resid * resid
+
+    return
+
+
 def sky_residual(params, sky, data, err):
     r"""Residual for 1D sky-scaling
 
     Used to find optimal rescaling of 1D spectrum, A,
-    for each spatial pixel
+    for each spatial pixel with ``lmfit``. :func:`fit_sky_scale`
+    gives the same solution in closed form.
 
     .. math::
 
@@ -19,6 +19,11 @@
 
 """
 
+import os
+import shutil
+import functools
+import concurrent.futures
+import tempfile
 import numpy as np
 import subprocess
 import astropy.io.fits as fits
@@ -45,26 +50,23 @@ def make_user_shifts_file(starparams_filename, usershifts_filename=None):
 
     # Get info from star table
     star_table = np.genfromtxt(starparams_filename, dtype=None, names=True, skip_header=1)
-    n_frames   = len(star_table)
 
     # Calculate shifts and save to file
     print('Calculating shifts')
-    shiftx, shifty = [0]*(n_frames-1), [0]*(n_frames-1)
-    for i in range(1, n_frames):
-        shiftx[i-1] = star_table['XCEN_pix'][i] - star_table['XCEN_pix'][0]
-        shifty[i-1] = star_table['YCEN_pix'][0] - star_table['YCEN_pix'][i]
+    shiftx = star_table['XCEN_pix'][1:] - star_table['XCEN_pix'][0]
+    shifty = star_table['YCEN_pix'][0] - star_table['YCEN_pix'][1:]
 
     if usershifts_filename is None:
         usershifts_filename = starparams_filename.replace('.txt', '_usershifts.txt')
 
-    np.savetxt(usershifts_filename, np.array([shiftx, shifty]).T, fmt='%f', delimiter='    ')
+    np.savetxt(usershifts_filename, np.column_stack([shiftx, shifty]), fmt='%f', delimiter='    ')
     print(' - Saved shifts file to', usershifts_filename)
 
     return
 
 
 def star_positions_batch(frame_list, psf_cut=0.8, edge_x=2., edge_y=2., star_ifu=None,
-                         starparams_filename=None, combinefiles_filename=None):
+                         starparams_filename=None, combinefiles_filename=None, max_workers=None):
     """Given a list of exposure file names, will find stars and measure PSFs.
 
     Given a list of exposure file names, will find stars and measure PSFs.
@@ -78,6 +80,7 @@ def star_positions_batch(frame_list, psf_cut=0.8, edge_x=2., edge_y=2., star_ifu
         edge_x (float): x_star > edge_x to include (i.e. not on the edge) [default = 2 pixels]
         edge_y (float): y_star > edge_y to include (i.e. not on the edge) [default = 2 pixels]
         star_if (int): IFU star is on
+        max_workers (int): number of frames to process in parallel, 1 to run them in this process [default = number of CPUs]
 
     Yields:
         starparams_filename (str): table with parameters of good stars
@@ -92,28 +95,20 @@ def star_positions_batch(frame_list, psf_cut=0.8, edge_x=2., edge_y=2., star_ifu
     if combinefiles_filename is None:
         combinefiles_filename = frame_list[0].split('_products')[0]+'_products/combine_'+str(datetime.date.today())+'.sof'
 
-    for ff, frame in enumerate(frame_list):
-        sci_reconstructed = kt.Exposure(frame)
-        sci_reconstructed.star_ifu = star_ifu
-
-        # Look for a star in the frame (based on having `star` in the target name) and fit a gaussian profile to it
-        try:
-            psf_center_x, psf_center_y, psf_fwhm, psf_ba, psf_pa, invert_comment = star_psf(sci_reconstructed, clobber=True)
-            print(psf_center_x)
-        except:
-            print('No star in %s' % frame)
-            psf_center_x, psf_center_y, psf_fwhm, psf_ba, psf_pa, invert_comment = np.nan, np.nan, np.nan, np.nan, np.nan, '# no star'
+    # Frames are independent, so measure them in parallel (map keeps them in order), or in this process if max_workers=1
+    measure_frame = functools.partial(_star_psf_frame, psf_cut=psf_cut, edge_x=edge_x, edge_y=edge_y, star_ifu=star_ifu)
+    if max_workers == 1:
+        results = [measure_frame(frame) for frame in frame_list]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(measure_frame, frame_list))
 
-        if psf_fwhm < psf_cut and sci_reconstructed.mode == 'A' and psf_center_x > edge_x and psf_center_y > edge_y:
+    for frame, (good, star_row) in zip(frame_list, results):
+        if good:
             combine_files.append([frame, 'SCI_RECONSTRUCTED'])
-            star_table.append([frame, sci_reconstructed.frame_time, psf_center_x, psf_center_y, psf_fwhm, psf_ba, psf_pa, invert_comment])
-        elif psf_center_x == np.nan:
-            star_table_bad.append([frame, sci_reconstructed.frame_time, psf_center_x, psf_center_y, psf_fwhm, psf_ba, psf_pa, invert_comment])
+            star_table.append(star_row)
         else:
-            print('WARNING: Something wrong with PSF in %s' % frame)
-            star_table_bad.append([frame, sci_reconstructed.frame_time, psf_center_x, psf_center_y, psf_fwhm, psf_ba, psf_pa, invert_comment])
-
-        del sci_reconstructed
+            star_table_bad.append(star_row)
 
     # Save star parameter output
     star_table = np.array(star_table)
@@ -137,6 +132,36 @@ def star_positions_batch(frame_list, psf_cut=0.8, edge_x=2., edge_y=2., star_ifu
     return
 
 
+def _star_psf_frame(frame, psf_cut, edge_x, edge_y, star_ifu):
+    """Measure the star PSF in one frame for :func:`star_positions_batch`
+
+    Returns:
+        good (bool): use the frame for combining?
+        star_row (list): frame, time and star parameters for the star table
+
+
+    """
+    sci_reconstructed = kt.Exposure.from_fitsio(frame)
+    sci_reconstructed.star_ifu = star_ifu
+
+    # Look for a star in the frame (based on having `star` in the target name) and fit a gaussian profile to it
+    try:
+        psf_center_x, psf_center_y, psf_fwhm, psf_ba, psf_pa, invert_comment = star_psf(sci_reconstructed, clobber=True)
+    except:
+        print('No star in %s' % frame)
+        psf_center_x, psf_center_y, psf_fwhm, psf_ba, psf_pa, invert_comment = np.nan, np.nan, np.nan, np.nan, np.nan, '# no star'
+
+    star_row = [frame, sci_reconstructed.frame_time, psf_center_x, psf_center_y, psf_fwhm, psf_ba, psf_pa, invert_comment]
+
+    good = psf_fwhm < psf_cut and sci_reconstructed.mode == 'A' and psf_center_x > edge_x and psf_center_y > edge_y
+    if not good and not np.isnan(psf_center_x):
+        print('WARNING: Something wrong with PSF in %s' % frame)
+
+    sci_reconstructed.close()
+
+    return good, star_row
+
+
 def find_star_ifu(exposure):
     """Find the IFUs in the SCI_RECONSTRUCTED cubes containing a star
 
@@ -152,10 +177,8 @@ def find_star_ifu(exposure):
 
         for ifu in range(1, 25):
 
-            ifu_comment = 'HIERARCH ESO OCS ARM%i NAME' % ifu
-
             # Look for star in name of IFU targe
-            if 'star' not in exposure.hdr[ifu_comment].lower():
+            if 'star' not in exposure.arm_name[ifu].lower():
                 continue
             else:
                 print('Star found in IFU %i' % ifu)
@@ -169,6 +192,7 @@ def star_fit_profile(exposure):
 
     Using ESO command line pipeline tools (``esorex``) extract the star from the exposure,
     fit a Gaussian profile to it, and save the fitted star to a new fits file ``star_file_name``.
+    ``esorex`` is run in a temporary directory, so frames can be processed in parallel.
 
 
     Args:
@@ -184,42 +208,45 @@ def star_fit_profile(exposure):
     if exposure.star_ifu is None:
         exposure.star_ifu = find_star_ifu(exposure)
 
-    # Make a copy of the IFU with the star
-    kmo_copy = 'esorex kmo_copy -x=1 -y=1 -z=1 -xsize=14 -ysize=14 -zsize=2048 -ifu=%s %s' % (str(exposure.star_ifu), exposure.filename)
-    subprocess.call(kmo_copy, shell=True)
-    status, copyfile = subprocess.getstatusoutput("find . -maxdepth 1 -iname copy.fits")
-
-    # Collapse the IFU to make an image
-    kmo_make_image = 'esorex kmo_make_image %s' % copyfile
-    subprocess.call(kmo_make_image, shell=True)
-    status, makeimagefile = subprocess.getstatusoutput("find . -maxdepth 1 -iname make_image.fits")
-    # Check the image, if weird, invert
-    image_hdu = fits.open(makeimagefile)
-    image     = image_hdu[1].data
-    test_star = np.nansum(image[3:-3, 3:-3] - np.nanmedian(image[3:-3, 3:-3]))
-    invert = False
-    if test_star < 0.:
-        print('WARNING: Weird star in %s, multiplying image by -1' % exposure.filename)
-        image_hdu[1].data = -1. * image
-        image_hdu.writeto(makeimagefile, clobber=True)
-        invert = True
-
-    # Rename star file
-    exposure.star_image_file = exposure.filename.strip('.fits') + '_star_image.fits'
-    subprocess.call('cp %s %s' % (makeimagefile, exposure.star_image_file), shell=True)
-
-    # Fit profile to star image
-    kmo_fit_profile = 'esorex kmo_fit_profile %s' % exposure.star_image_file
-    subprocess.call(kmo_fit_profile, shell=True)
-    status, fitprofilefile = subprocess.getstatusoutput("find . -maxdepth 1 -iname fit_profile.fits")
-
-    # Tidy up
-    star_file_name     = exposure.filename.strip('.fits')+'_star_psf.fits'
-    rename_fit_profile = 'mv %s %s' % (fitprofilefile, star_file_name)
-    delete_temps       = 'rm %s %s' % (copyfile, makeimagefile)
-
-    subprocess.call(rename_fit_profile, shell=True)
-    subprocess.call(delete_temps, shell=True)
+    # Run esorex in a temporary directory so its products have known paths
+    # and don't collide with those of other frames
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        # Make a copy of the IFU with the star
+        kmo_copy = ['esorex', 'kmo_copy', '-x=1', '-y=1', '-z=1', '-xsize=14', '-ysize=14', '-zsize=2048',
+                    '-ifu=%s' % str(exposure.star_ifu), os.path.abspath(exposure.filename)]
+        subprocess.run(kmo_copy, check=True, cwd=tmpdir)
+        copyfile = kt.insensitive_glob(os.path.join(tmpdir, 'copy.fits'))[0]
+
+        # Collapse the IFU to make an image
+        kmo_make_image = ['esorex', 'kmo_make_image', copyfile]
+        subprocess.run(kmo_make_image, check=True, cwd=tmpdir)
+        makeimagefile = kt.insensitive_glob(os.path.join(tmpdir, 'make_image.fits'))[0]
+
+        # Check the image, if weird, invert
+        image_hdu = fits.open(makeimagefile)
+        image     = image_hdu[1].data
+        test_star = np.nansum(image[3:-3, 3:-3] - np.nanmedian(image[3:-3, 3:-3]))
+        invert = False
+        if test_star < 0.:
+            print('WARNING: Weird star in %s, multiplying image by -1' % exposure.filename)
+            image_hdu[1].data = -1. * image
+            image_hdu.writeto(makeimagefile, overwrite=True, output_verify='ignore', checksum=False)
+            invert = True
+        image_hdu.close()
+
+        # Rename star file
+        exposure.star_image_file = exposure.filename.strip('.fits') + '_star_image.fits'
+        shutil.copyfile(makeimagefile, exposure.star_image_file)
+
+        # Fit profile to star image
+        kmo_fit_profile = ['esorex', 'kmo_fit_profile', os.path.abspath(exposure.star_image_file)]
+        subprocess.run(kmo_fit_profile, check=True, cwd=tmpdir)
+        fitprofilefile = kt.insensitive_glob(os.path.join(tmpdir, 'fit_profile.fits'))[0]
+
+        # Tidy up, the temporary files are removed with tmpdir
+        star_file_name = exposure.filename.strip('.fits')+'_star_psf.fits'
+        shutil.move(fitprofilefile, star_file_name)
 
     print('Saved star psf profile to '+star_file_name)
 
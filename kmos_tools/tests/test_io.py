@@ -0,0 +1,22 @@
+import os
+
+from kmos_tools import io
+
+
+def test_insensitive_glob(tmp_path, monkeypatch):
+    "Check matching ignores case, in file and directory names, as the glob of either case did."
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join('Sub', 'Deeper'))
+    for name in ['ROTATE.fits', os.path.join('Sub', 'copy.FITS'), 'notes.txt']:
+        open(name, 'w').close()
+
+    assert io.insensitive_glob('rotate.fits') == ['ROTATE.fits']
+    assert io.insensitive_glob('*.FITS') == ['ROTATE.fits']
+    assert io.insensitive_glob(os.path.join('sub', 'COPY.fits')) == [os.path.join('Sub', 'copy.FITS')]
+    assert io.insensitive_glob(os.path.join('s*', '*')) == [os.path.join('Sub', 'Deeper'), os.path.join('Sub', 'copy.FITS')]
+
+    # a trailing separator only matches directories, and keeps the separator
+    assert io.insensitive_glob('Sub' + os.sep) == ['Sub' + os.sep]
+    assert io.insensitive_glob('sub' + os.sep) == ['Sub' + os.sep]
+    assert io.insensitive_glob(os.path.join('Sub', '*', '')) == [os.path.join('Sub', 'Deeper', '')]
+    assert io.insensitive_glob('notes.txt' + os.sep) == []
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from kmos_tools import sky_clean
+
+
+@pytest.mark.parametrize("has_numba", [True, False])
+def test_fit_sky_scale_matches_lmfit(monkeypatch, has_numba):
+    "Check the closed-form sky scaling matches fitting sky_residual with lmfit, with NaNs in the data and sky."
+    lmfit = pytest.importorskip("lmfit")
+    monkeypatch.setattr(sky_clean, "HAS_NUMBA", has_numba)
+
+    rng  = np.random.default_rng(3)
+    sky  = rng.uniform(0.5, 2., 60)
+    err  = rng.uniform(0.1, 0.3, 60)
+    data = rng.uniform(0.5, 1.5, (2, 1, 3, 3)) * sky[:, None, None] + rng.normal(0., 0.2, (2, 60, 3, 3))
+    sky[[5, 40]] = np.nan
+    data[0, 10:14, 1, 1] = np.nan
+    data[1, :, 2, 0] = np.nan
+
+    scale, chisquared = sky_clean.fit_sky_scale(data, sky, err)
+    assert scale.shape == chisquared.shape == (2, 3, 3)
+
+    for k, i, j in np.ndindex(scale.shape):
+        params = lmfit.Parameters()
+        params.add('scale', value=1.)
+        out = lmfit.minimize(sky_clean.sky_residual, params, args=(sky, data[k, :, i, j], err))
+        # with no good data lmfit leaves the starting value, the closed form gives 0, either way it subtracts NaN
+        if np.isfinite(data[k, :, i, j]).any():
+            np.testing.assert_allclose(scale[k, i, j], out.params['scale'].value, rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(chisquared[k, i, j], out.chisqr, rtol=1e-9, atol=1e-9)
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from kmos_tools import tools
+
+
+@pytest.mark.parametrize("box_pts", [1, 4, 5, 100, 101])
+@pytest.mark.parametrize("dtype", [float, int])
+def test_smooth_boxcar_simple_matches_convolve(box_pts, dtype):
+    "Check the running mean matches np.convolve 'same', edges included."
+    y = (np.random.default_rng(1).normal(size=500) * 50).astype(dtype)
+    expected = np.convolve(y, np.ones(box_pts)/box_pts, mode='same')
+    np.testing.assert_allclose(tools.smooth_boxcar_simple(y, box_pts), expected, rtol=1e-12, atol=1e-12)
+
+
+def test_scale_zerotoone():
+    "Check the data minimum maps to zero and the maximum to one, ignoring NaNs."
+    np.testing.assert_allclose(tools.scale_zerotoone(np.array([1., 3., np.nan, 5.])), [0., 0.5, np.nan, 1.])
+    np.testing.assert_allclose(tools.scale_zerotoone(np.array([1., 3., np.nan, 5.]), zero=-1., one=3.), [-1., 1., np.nan, 3.])
+
+
+@pytest.mark.parametrize("has_numba", [True, False])
+def test_smooth_boxcar_nan_across_tile(monkeypatch, has_numba):
+    "Check a NaN only blanks the windows containing it, also across the numba tile edges."
+    monkeypatch.setattr(tools, "HAS_NUMBA", has_numba)
+    rng = np.random.default_rng(2)
+    x, err = rng.normal(5., 1., 40000), rng.uniform(0.5, 2., 40000)
+    x[[100, 16384]] = np.nan
+    N = 5
+    ave = tools.smooth_boxcar(x, N, weights=err)
+
+    windows = np.lib.stride_tricks.sliding_window_view
+    expected = (windows(x * err, N).sum(axis=1)) / windows(err, N).sum(axis=1)
+    assert np.flatnonzero(np.isnan(expected)).tolist() == list(range(96, 101)) + list(range(16380, 16385))
+    # the numpy fallback differences running sums, so is only good to ~1e-11 here
+    np.testing.assert_allclose(ave, expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize("assume_sorted", [False, True])
+def test_find_nearest_i_inputs(assume_sorted):
+    "Check Quantities and 1-element arrays still work, as with the plain argmin."
+    import astropy.units as u
+    wave = np.linspace(2., 2.4, 100)
+    assert tools.find_nearest_i(2.1, wave, assume_sorted=assume_sorted) == 25
+    assert tools.find_nearest_i(np.array([2.1]), wave, assume_sorted=assume_sorted) == 25
+    assert tools.find_nearest_i(2.1*u.um, wave*u.um, assume_sorted=assume_sorted) == 25
+
+
+def _convolve3D_reference(cube, sigl_pix, sigxy_pix, mask):
+    "The original convolve3D: 2D astropy convolution of each slice, then 1D of each spaxel."
+    from astropy.convolution import convolve, Gaussian1DKernel, Gaussian2DKernel
+    inter = np.zeros(cube.shape)
+    final = np.zeros(cube.shape)
+    for i in range(cube.shape[0]):
+        inter[i] = convolve(cube[i], Gaussian2DKernel(sigxy_pix), mask=mask[i])
+    for i, j in np.ndindex(cube.shape[1:]):
+        final[:, i, j] = convolve(inter[:, i, j], Gaussian1DKernel(sigl_pix), mask=mask[:, i, j])
+    return final
+
+
+@pytest.mark.filterwarnings("ignore:nan_treatment='interpolate'")
+@pytest.mark.parametrize("has_numba", [True, False])
+@pytest.mark.parametrize("use_mask", [False, True])
+def test_convolve3D_nan_and_mask(monkeypatch, has_numba, use_mask):
+    "Check NaN and masked pixels are interpolated over as by the original per-slice convolution."
+    monkeypatch.setattr(tools, "HAS_NUMBA", has_numba)
+    rng  = np.random.default_rng(4)
+    cube = rng.normal(5., 1., (40, 9, 9))
+    cube[:, 0, :2] = np.nan
+    cube[12, 4, 4] = np.nan
+    mask = np.zeros(cube.shape, dtype=bool)
+    if use_mask:
+        mask[:, 6, 2] = True
+        mask[20:24, 3, 7] = True
+
+    result   = tools.convolve3D(cube, 2., 1.3, mask=mask if use_mask else None)
+    expected = _convolve3D_reference(cube, 2., 1.3, mask)
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("sigl_pix", [2., 10.])
+def test_convolve3D_clean(sigl_pix):
+    "Check the mask-free paths, in blocks of slices (sigl_pix <= 8) or by FFT, against the original."
+    cube = np.random.default_rng(5).normal(5., 1., (200, 9, 9))
+    result   = tools.convolve3D(cube, sigl_pix, 1.3)
+    expected = _convolve3D_reference(cube, sigl_pix, 1.3, np.zeros(cube.shape))
+    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-12)
+
+    # blocks small enough to split the cube still give the same
+    blocked = tools._convolve3D_tiled(cube, tools._gaussian_kernel(sigl_pix), tools._gaussian_kernel(1.3), np.float64, tile_bytes=1)
+    np.testing.assert_allclose(blocked, expected, rtol=0, atol=1e-12)
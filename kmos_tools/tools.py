@@ -11,9 +11,14 @@ __author__ = "Charlotte Mason (UCLA)"
 import numpy as np
 import astropy
 from astropy.convolution import convolve
+from scipy import ndimage, signal
 import re
+import functools
+import concurrent.futures
 
-__all__ = ["scale_zerotoone", "find_nearest", "find_nearest_i"]
+from ._compat import njit, prange, HAS_NUMBA, numexpr
+
+__all__ = ["scale_zerotoone", "find_nearest", "find_nearest_i", "find_nearest_i_bulk"]
 
 
 def scale_zerotoone(vectordata, zero=0.0, one=1.0):
@@ -30,16 +35,14 @@ def scale_zerotoone(vectordata, zero=0.0, one=1.0):
 
     """
 
-    oldmax   = np.nanmin(vectordata)
-    oldmin   = np.nanmax(vectordata)
-    oldrange = oldmax - oldmin
-
-    newmin   = zero
-    newmax   = one
-    newrange = newmax - newmin
+    lo    = np.nanmin(vectordata)
+    hi    = np.nanmax(vectordata)
+    scale = (one - zero) / (hi - lo)
 
-    # Rescale array
-    newvalue = newrange * (vectordata-oldmin)/oldrange + newmin
+    # Rescale array, in place in a single output buffer
+    newvalue = np.subtract(vectordata, lo, dtype=np.result_type(vectordata, 1.))
+    newvalue *= scale
+    newvalue += zero
 
     return newvalue
 
@@ -50,9 +53,15 @@ def natural_sort(my_list):
 
     Based on: https://stackoverflow.com/questions/4836710/is-there-a-built-in-function-for-string-natural-sort
     """
-    convert = lambda text: int(text) if text.isdigit() else text.lower()
-    alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
-    return sorted(my_list, key=alphanum_key)
+    return sorted(my_list, key=_natural_key)
+
+
+_NAT_RE = re.compile('([0-9]+)')
+
+
+def _natural_key(key):
+    """Sort key for :func:`natural_sort`, splitting the digits out as ints"""
+    return [int(c) if c.isdigit() else c.lower() for c in _NAT_RE.split(key)]
 
 
 def determine_aspect(shape, extent):
@@ -68,7 +77,21 @@ def gaussian(x, mu, sig):
     """
     Normalized gaussian function
     """
-    gauss = 1. / (np.sqrt(2*np.pi)*sig) * np.exp(-(x - mu)**2./(2*sig**2.))
+    norm = 1. / (np.sqrt(2*np.pi)*sig)
+    if not isinstance(x, np.ndarray):
+        return norm * np.exp(-(x - mu)**2./(2*sig**2.))
+
+    # one pass with numexpr if it can use several threads, single threaded it's slower than numpy's exp
+    if numexpr is not None and numexpr.get_num_threads() > 1:
+        return numexpr.evaluate('norm * exp((x - mu) * (x - mu) * a)',
+                                local_dict={'norm': norm, 'x': x, 'mu': mu, 'a': -0.5 / sig**2.})
+
+    # otherwise in place in a single buffer
+    gauss  = np.subtract(x, mu, dtype=np.result_type(x, mu, norm))
+    gauss *= gauss
+    gauss *= -0.5 / sig**2.
+    np.exp(gauss, out=gauss)
+    gauss *= norm
     return gauss
 
 
@@ -84,103 +107,416 @@ def gaussian_psf(cube, fwhm_as, xy_step=0.2,
     if yo is None:
         yo = (shape[0] - 1) / 2 - (shape[0] % 2 - 1)
 
-    y, x = np.indices(shape)
-    r = psf_radius(xo, yo, x, y, pa_deg, ba)
+    y, x = np.ogrid[:shape[0], :shape[1]]
+    r2 = psf_radius2(xo, yo, x, y, pa_deg, ba)
     fwhm = fwhm_as / xy_step
 
-    psf = np.exp(-0.5 * (r / (fwhm / 2.35482)) ** 2)
+    # in place, so the whole PSF is the one array made in psf_radius2
+    psf  = r2
+    psf *= -0.5 / (fwhm / 2.35482) ** 2
+    np.exp(psf, out=psf)
+    psf /= psf.sum()
 
-    return psf / psf.sum()
+    return psf
 
 
 def psf_radius(xo, yo, x, y, pa_deg=0., ba=1.):
     """Computes the radii, taking into account the variance and the elliptic shape
     """
+    return np.sqrt(psf_radius2(xo, yo, x, y, pa_deg, ba))
+
+
+def psf_radius2(xo, yo, x, y, pa_deg=0., ba=1.):
+    """Computes the squared radii, taking into account the variance and the elliptic shape
+
+    The rotation is expanded analytically to r^2 = A dx^2 + B dy^2 + C dx dy,
+    so no rotated coordinate grids are made
+    """
     dx = xo - x
     dy = yo - y
 
     # Rotation matrix around z axis
     # R(90)=[[0, -1], [1, 0]] so clock-wise y -> -x & x -> y
     radian_pa = np.radians(pa_deg)
-    dx_p = dx * np.cos(radian_pa) - dy * np.sin(radian_pa)
-    dy_p = dx * np.sin(radian_pa) + dy * np.cos(radian_pa)
+    c, s = np.cos(radian_pa), np.sin(radian_pa)
+    A = c ** 2 + s ** 2 / ba ** 2
+    B = s ** 2 + c ** 2 / ba ** 2
+    C = 2. * s * c * (1. / ba ** 2 - 1.)
+
+    # cross term first, as it has the full shape of the grid, then add the rest in place
+    r2  = C * dx * dy
+    r2 += A * dx * dx
+    r2 += B * dy * dy
+    return r2
 
-    return np.sqrt(dx_p ** 2 + dy_p ** 2 / ba ** 2)
 
+@functools.lru_cache(maxsize=32)
+def _gaussian_kernel(sigma):
+    """Array of the astropy 1D Gaussian kernel, cached and read-only as it's shared between calls"""
+    kernel = astropy.convolution.Gaussian1DKernel(sigma).array
+    kernel.flags.writeable = False
+    return kernel
 
-def convolve3D(cube, sigl_pix, sigxy_pix=1.3, mask=None):
+
+def convolve3D(cube, sigl_pix, sigxy_pix=1.3, mask=None, dtype=None):
     """From https://github.com/spacetelescope/cube-tools
+
+    The Gaussian kernels are separable, so the cube is smoothed with 1D
+    convolutions over the whole cube (x, y, then wavelength) rather than a
+    2D convolution per slice and a 1D convolution per spaxel. NaN and masked
+    pixels are interpolated over exactly as by the 2D spatial convolution,
+    by convolving the good pixels and their weights separately.
+
+    Cubes with no NaN or masked pixels take a fast path of three 1D passes in C,
+    equivalent to ndimage.gaussian_filter but with the astropy kernels (cut at
+    4 sigma) and the zero boundary of the astropy convolutions. These are done in
+    blocks of wavelength slices, so each block is still in cache for the spectral
+    pass, or with the spectral pass by FFT for sigl_pix > 8, where that's quicker.
+
+    The smoothed cube is float64, unless another dtype is given, e.g.
+    dtype=np.float32 halves the memory traffic and the size of the result.
+    """
+    dtype = np.float64 if dtype is None else np.dtype(dtype)
+    kl  = _gaussian_kernel(sigl_pix)   # spectral (1-D) kernel
+    kxy = _gaussian_kernel(sigxy_pix)  # spatial kernel, for each of x and y
+
+    bad = np.isnan(cube)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        bad |= mask
+
+    if not bad.any():
+        if sigl_pix <= 8:
+            return _convolve3D_tiled(cube, kl, kxy, dtype)
+        final = ndimage.correlate1d(cube, kxy, axis=2, output=dtype, mode='constant', cval=0.)
+        final = ndimage.correlate1d(final, kxy, axis=1, mode='constant', cval=0., output=final)
+        # long spectral kernels are cheaper by FFT
+        return signal.fftconvolve(final, kl[:, np.newaxis, np.newaxis].astype(dtype), mode='same', axes=0)
+
+    # spatial smoothing, slices in parallel with numba if we have it
+    good = ~bad
+    if HAS_NUMBA:
+        inter = np.empty(cube.shape, dtype=dtype)
+        _separable_gauss2d(np.asarray(cube, dtype=dtype), good, kxy, inter)
+    else:
+        weight = good.astype(float)
+        inter  = np.where(good, cube, 0.)
+        for k in (kxy[np.newaxis, np.newaxis, :], kxy[np.newaxis, :, np.newaxis]):
+            inter  = convolve(inter, k, boundary='fill', fill_value=0., normalize_kernel=False)
+            weight = convolve(weight, k, boundary='fill', fill_value=1., normalize_kernel=False)
+        with np.errstate(invalid='ignore'):
+            inter /= weight
+
+    # spectral smoothing, in C for all spaxels, then with astropy for spaxels with masked or NaN pixels to interpolate over
+    final = ndimage.correlate1d(inter, kl, axis=0, output=dtype, mode='constant', cval=0.)
+    bad   = np.isnan(inter)
+    if mask is not None:
+        bad |= mask
+    bad = bad.any(axis=0)
+    if bad.any():
+        final[:, bad] = convolve(inter[:, bad], kl[:, np.newaxis], mask=None if mask is None else mask[:, bad])
+
+    return final
+
+
+def _convolve3D_tiled(cube, kl, kxy, dtype, tile_bytes=2**21, max_workers=None):
+    """Mask-free :func:`convolve3D` done in blocks of wavelength slices, in threads
+
+    Each block is read with a halo of half the spectral kernel on either side, so
+    the result is exactly that of smoothing the whole cube at once, with zeros
+    beyond the ends of the cube.
     """
-    if mask is None:
-        mask = np.zeros_like(cube)
+    nl    = cube.shape[0]
+    halo  = len(kl) // 2
+    slice_bytes = max(cube[0].size, 1) * np.dtype(dtype).itemsize
+    tile  = max(4 * halo, tile_bytes // slice_bytes, 1)
+    final = np.empty(cube.shape, dtype=dtype)
+
+    def smooth_block(l0):
+        l1   = min(l0 + tile, nl)
+        a, b = max(l0 - halo, 0), min(l1 + halo, nl)
+        block = ndimage.correlate1d(cube[a:b], kxy, axis=2, output=dtype, mode='constant', cval=0.)
+        ndimage.correlate1d(block, kxy, axis=1, output=block, mode='constant', cval=0.)
+        ndimage.correlate1d(block, kl, axis=0, output=block, mode='constant', cval=0.)
+        final[l0:l1] = block[l0-a:l1-a]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(smooth_block, range(0, nl, tile)))
 
-    inter = np.zeros(shape=cube.shape)  # result of first pass (2-D smoothing) goes here
-    final = np.zeros(shape=cube.shape)  # final result goes here
+    return final
 
-    kl  = astropy.convolution.Gaussian1DKernel(sigl_pix)   # spectral (1-D) kernel
-    kxy = astropy.convolution.Gaussian2DKernel(sigxy_pix)  # spatial (2-D) kernel
 
-    # spatial smoothing
-    for i in range(cube.shape[0]):
-        inter[i, :, :] = convolve(cube[i, :, :], kxy, mask=mask[i, :, :])
+@njit(parallel=True, cache=True)
+def _separable_gauss2d(cube, good, k, out):
+    """Smooth each slice of a cube [wavelength, y, x] with the 1D kernel k along x then y
 
-    # spectral smoothing
-    for i in range(cube.shape[1]):
-        for j in range(cube.shape[2]):
-            final[:, i, j] = convolve(inter[:, i, j], kl, mask=mask[:, i, j])
+    Bad pixels are interpolated over by dividing by the kernel weight of the
+    good pixels, with pixels off the edge counted as zero with full weight, as
+    astropy's convolve does with boundary='fill'.
+    """
+    nl, ny, nx = cube.shape
+    nk = len(k)
+    h  = nk // 2
+    for i in prange(nl):
+        num = np.empty((ny, nx))
+        den = np.empty((ny, nx))
+        for y in range(ny):
+            for x in range(nx):
+                s, w = 0., 0.
+                for j in range(nk):
+                    xx = x + j - h
+                    if xx < 0 or xx >= nx:
+                        w += k[j]
+                    elif good[i, y, xx]:
+                        s += k[j] * cube[i, y, xx]
+                        w += k[j]
+                num[y, x] = s
+                den[y, x] = w
+        for y in range(ny):
+            for x in range(nx):
+                s, w = 0., 0.
+                for j in range(nk):
+                    yy = y + j - h
+                    if yy < 0 or yy >= ny:
+                        w += k[j]
+                    else:
+                        s += k[j] * num[yy, x]
+                        w += k[j] * den[yy, x]
+                out[i, y, x] = s / w if w != 0. else np.nan
+
+
+def convolve3D_fast(cube, sigl_pix, sigxy_pix=1.3):
+    """Approximate :func:`convolve3D` for wide kernels
+
+    Along axes where sigma > 4 the Gaussian is approximated by three successive
+    box filters of odd width w ~ sqrt(12 sigma^2 / 3 + 1), which are running sums,
+    so the cost doesn't grow with sigma. Narrower kernels are done exactly.
+    Cubes with NaNs are passed to :func:`convolve3D` to interpolate over them.
+    """
+    if np.isnan(cube).any():
+        return convolve3D(cube, sigl_pix, sigxy_pix)
+
+    final = np.array(cube, dtype=float)
+    for axis, sig in ((2, sigxy_pix), (1, sigxy_pix), (0, sigl_pix)):
+        if sig > 4:
+            widths = _box_widths(sig, 3)
+            # zero pad by the reach of all the boxes, so each pass smooths into the
+            # padding rather than refilling it, as for a single zero-filled convolution
+            reach = sum(w // 2 for w in widths)
+            pad = [(0, 0)] * final.ndim
+            pad[axis] = (reach, reach)
+            padded = np.pad(final, pad)
+            for w in widths:
+                ndimage.uniform_filter1d(padded, w, axis=axis, output=padded, mode='constant', cval=0.)
+            final = padded[(slice(None),) * axis + (slice(reach, padded.shape[axis] - reach),)]
+        else:
+            k = _gaussian_kernel(sig)
+            ndimage.correlate1d(final, k, axis=axis, output=final, mode='constant', cval=0.)
 
     return final
 
 
+def _box_widths(sig, n):
+    """Odd widths of n boxes whose successive convolution best matches a Gaussian of sigma sig
+
+    The ideal width is sqrt(12 sig^2 / n + 1), so mixes the odd widths either side
+    of it to get the variance right (Kovesi 2010)
+    """
+    wl = int(np.sqrt(12. * sig**2 / n + 1.))
+    if wl % 2 == 0:
+        wl -= 1
+    m = int(round((12. * sig**2 - n * wl**2 - 4. * n * wl - 3. * n) / (-4. * wl - 4.)))
+    return [wl] * m + [wl + 2] * (n - m)
+
+
 def smooth_boxcar(x, N, weights=None, squared=False):
     """
     Moving average, weighted by inverse variance
     Weights should be error
     """
-    maxx = np.sum(x)
-    x = x / maxx
     if weights is None:
-        cumx = np.cumsum(np.insert(x, 0, 0))
+        maxx = np.sum(x)
+        x = x / maxx
+        cumx = np.cumsum(np.insert(x, 0, 0), dtype=np.float64)
         return maxx*(cumx[N:]-cumx[:-N])/N
     else:
-        wmax = np.sum(weights)
-        weights = weights / wmax
+        # weighted average doesn't depend on the normalisation of x or weights
+        x       = np.asarray(x, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
         if squared: weights = weights**2.
-        cumx = np.cumsum(np.insert(x*weights, 0, 0), dtype=np.float128)
-        cumw = np.cumsum(np.insert(weights, 0, 0), dtype=np.float128)
-        ave  = maxx*(cumx[N:]-cumx[:-N])/(cumw[N:]-cumw[:-N])
+        if HAS_NUMBA:
+            return _boxcar_w(x, weights, N)
+        # leave non-finite samples out of the sums, and make the windows with them NaN
+        xw   = x * weights
+        bad  = ~(np.isfinite(xw) & np.isfinite(weights))
+        cumx = np.cumsum(np.insert(np.where(bad, 0., xw), 0, 0))
+        cumw = np.cumsum(np.insert(np.where(bad, 0., weights), 0, 0))
+        cumb = np.cumsum(np.insert(bad, 0, False))
+        ave  = (cumx[N:]-cumx[:-N])/(cumw[N:]-cumw[:-N])
+        ave[cumb[N:] > cumb[:-N]] = np.nan
         return ave
 
 
-def smooth_boxcar_simple(y, box_pts=100):
-    box = np.ones(box_pts)/box_pts
-    y_smooth = np.convolve(y, box, mode='same')
+@njit(cache=True, fastmath=False)
+def _neumaier_add(s, c, v):
+    """Add v to the sum s, keeping the lost low-order bits in c"""
+    t = s + v
+    if abs(s) >= abs(v):
+        c += (s - t) + v
+    else:
+        c += (v - t) + s
+    return t, c
+
+
+@njit(parallel=True, cache=True, fastmath=False)
+def _boxcar_w(x, w, N, tile=16384):
+    """Rolling weighted mean of x in windows of N, with compensated running sums
+
+    The output is split into tiles which are done in parallel, each seeded
+    with the sum over its own first window. Non-finite samples are counted
+    rather than summed, so windows containing them are NaN and the sums are
+    left clean for the windows after.
+    """
+    n      = len(x) - N + 1
+    ave    = np.empty(max(n, 0))
+    n_tile = (n + tile - 1) // tile
+    for t in prange(n_tile):
+        start = t * tile
+        stop  = min(start + tile, n)
+        sx, cx, sw, cw = 0., 0., 0., 0.
+        n_bad = 0
+        for j in range(start, start + N):
+            xw = x[j] * w[j]
+            if np.isfinite(xw) and np.isfinite(w[j]):
+                sx, cx = _neumaier_add(sx, cx, xw)
+                sw, cw = _neumaier_add(sw, cw, w[j])
+            else:
+                n_bad += 1
+        ave[start] = (sx + cx) / (sw + cw) if n_bad == 0 else np.nan
+        for i in range(start + 1, stop):
+            j  = i + N - 1
+            xw = x[j] * w[j]
+            if np.isfinite(xw) and np.isfinite(w[j]):
+                sx, cx = _neumaier_add(sx, cx, xw)
+                sw, cw = _neumaier_add(sw, cw, w[j])
+            else:
+                n_bad += 1
+            j  = i - 1
+            xw = x[j] * w[j]
+            if np.isfinite(xw) and np.isfinite(w[j]):
+                sx, cx = _neumaier_add(sx, cx, -xw)
+                sw, cw = _neumaier_add(sw, cw, -w[j])
+            else:
+                n_bad -= 1
+            ave[i] = (sx + cx) / (sw + cw) if n_bad == 0 else np.nan
+    return ave
+
+
+def smooth_boxcar_simple(y, box_pts=100, mode='constant'):
+    """
+    Moving average with a running sum, same length as y
+    Default mode pads with zeros, as np.convolve(y, box, mode='same')
+    """
+    y_smooth = ndimage.uniform_filter1d(y, size=box_pts, output=np.float64, mode=mode)
     return y_smooth
 
 
-def find_nearest_i(value, array):
+def find_nearest_i(value, array, assume_sorted=False):
     """Find the index of nearest number to a given value in an array
 
     Args:
         value (float): value to search for
         array (ndarray): array to look in
+        assume_sorted (bool): array is ascending with no NaNs, so binary search it
 
     Returns:
         index (int): index in array of nearest neighbour match
     """
+    # only plain arrays and scalars take the fast paths, so e.g. Quantities keep their units
+    plain = type(array) is np.ndarray and np.ndim(value) == 0 and not isinstance(value, np.ndarray)
+
+    if assume_sorted and plain and array.ndim == 1:
+        if len(array) < 2:
+            return 0
+        return int(_nearest_in_sorted(array, value))
+
+    if plain and HAS_NUMBA and array.dtype.kind in 'fiu' and array.dtype.isnative:
+        return _nearest_idx(float(value), array.ravel())
+
     idx = (np.abs(array-value)).argmin()
     return idx
 
 
-def find_nearest(value, array):
+@njit(cache=True)
+def _nearest_idx(value, array):
+    """Single scan for the index of the nearest value, without the array of distances
+
+    Gives the same as np.abs(array-value).argmin(), including the first NaN winning
+    """
+    best_idx  = 0
+    best_dist = np.inf
+    for i in range(len(array)):
+        d = array[i] - value
+        d = -d if d < 0 else d
+        if np.isnan(d):
+            return i
+        if d < best_dist:
+            best_idx  = i
+            best_dist = d
+    return best_idx
+
+
+def _nearest_in_sorted(sa, values):
+    """Positions in the ascending, NaN-free array sa (at least 2 long) nearest to values
+
+    Ties go to the smaller value, and runs of equal values to their first position
+    """
+    idx   = np.clip(np.searchsorted(sa, values), 1, len(sa)-1)
+    left  = sa[idx-1]
+    right = sa[idx]
+    pick  = np.where(values - left <= right - values, idx-1, idx)
+    # first of any run of equal values
+    return np.searchsorted(sa, sa[pick])
+
+
+def find_nearest_i_bulk(values, array):
+    """Find the indices of nearest numbers to many values in an array
+
+    Sorts ``array`` once and binary searches it for all the values, rather than
+    scanning the whole array for each value as :func:`find_nearest_i` does.
+    Ties go to the smaller array value, and repeated array values to their
+    first index, as ``argmin`` does for an ascending array. NaNs in ``array``
+    are never matched.
+
+    Args:
+        values (float or ndarray): values to search for
+        array (ndarray): array to look in
+
+    Returns:
+        index (ndarray): indices in array of nearest neighbour matches, same shape as ``values``
+    """
+    array  = np.ravel(array)
+    values = np.asarray(values)
+
+    order = np.argsort(array, kind='stable')
+    sa    = array[order]
+    sa    = sa[:np.count_nonzero(~np.isnan(sa))]  # NaNs are sorted to the end
+    if len(sa) < 2:
+        return np.zeros(values.shape, dtype=np.intp)
+
+    return order[_nearest_in_sorted(sa, values)]
+
+
+def find_nearest(value, array, assume_sorted=False):
     """Find the nearest number to a given value in an array
 
     Args:
         value (float): value to search for
         array (ndarray): array to look in
+        assume_sorted (bool): array is ascending with no NaNs, so binary search it
 
     Returns:
         (float): value of nearest neighbour match in ``array``.
     """
-    idx = find_nearest_i(value, array)
+    idx = find_nearest_i(value, array, assume_sorted=assume_sorted)
     return float(array[idx])